@@ -1,29 +1,144 @@
 import sqlite3
 from typing import List, Dict
+from collections import OrderedDict
+from contextlib import contextmanager
 import logging
 import os
+import threading
 
 class DatabaseManager:
     """Manages SQLite database operations for image tags."""
 
+    # Upper bound on cached tag name -> id mappings
+    TAG_ID_CACHE_SIZE = 10000
+
     def __init__(self, db_path: str = "image_tags.sqlite"):
         """Initialize database connection and create tables if they don't exist."""
         self.db_path = db_path
         self.logger = logging.getLogger(__name__)
+        # One connection is shared by all calls (and threads); transactions
+        # are managed explicitly, so autocommit mode is used. Since the
+        # connection lives as long as the manager, its statement cache keeps
+        # the hot queries compiled across calls.
+        self._conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        self._lock = threading.RLock()
+        # Tag names repeat heavily across images, so remember their ids
+        self._tag_id_cache: "OrderedDict[str, int]" = OrderedDict()
+        # Set while batch() holds an outer transaction open; ids of tags
+        # created inside it are only cached once it commits
+        self._in_batch = False
+        self._batch_tag_ids: Dict[str, int] = {}
         self._init_database()
 
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the enclosed statements in one transaction, rolling back on error.
+        
+        Inside batch() this becomes a savepoint of the outer transaction,
+        so a failed write is undone without committing or losing the rest.
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
+            if self._in_batch:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    yield cursor
+                except BaseException:
+                    cursor.execute("ROLLBACK TO write")
+                    cursor.execute("RELEASE write")
+                    raise
+                cursor.execute("RELEASE write")
+                return
+
+            # Take the write lock up front rather than upgrading mid-transaction
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                self._conn.rollback()
+                raise
+            cursor.execute("COMMIT")
+
+    @contextmanager
+    def batch(self):
+        """
+        Group the writes of several calls into one transaction.
+        
+        Writes from any thread using this manager join the transaction,
+        which is committed (one fsync) when the block exits, or rolled
+        back if it raises.
+        """
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._in_batch = True
+        except sqlite3.Error as e:
+            self.logger.error(f"Error starting batch: {e}")
+            raise
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self._in_batch = False
+                self._batch_tag_ids.clear()
+                self._conn.rollback()
+            raise
+        try:
+            with self._lock:
+                self._in_batch = False
+                self._conn.execute("COMMIT")
+                self._cache_tag_ids(self._batch_tag_ids)
+                self._batch_tag_ids.clear()
+        except sqlite3.Error as e:
+            self.logger.error(f"Error committing batch: {e}")
+            with self._lock:
+                self._batch_tag_ids.clear()
+                self._conn.rollback()
+            raise
+
+    def _apply_pragmas(self, cursor: sqlite3.Cursor):
+        """
+        Tune the connection for concurrent reads and cheaper commits.
+
+        WAL lets readers proceed while a write is in progress, and with
+        synchronous=NORMAL a commit no longer waits on an fsync of the
+        main database file. In-memory databases have no journal file, so
+        the journal and mmap settings are skipped for them.
+        """
+        # Only takes effect on a fresh database, and only before anything
+        # (including the journal_mode switch below) writes its header
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if self.db_path != ":memory:":
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-20000")  # 20 MB
+
     def _init_database(self):
         """Initialize the database schema."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            with self._lock:
+                cursor = self._conn.cursor()
+                self._apply_pragmas(cursor)
                 
                 # Create images table
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS images (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         file_path TEXT UNIQUE NOT NULL,
-                        md5_hash TEXT UNIQUE NOT NULL,
+                        md5_hash BLOB UNIQUE NOT NULL,
                         original_filename TEXT NOT NULL,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         process_count INTEGER DEFAULT 0
@@ -49,29 +164,87 @@ class DatabaseManager:
                         UNIQUE(image_id, tag_id)
                     )
                 """)
+
+                self._create_indexes(cursor)
+                self._migrate_md5_hashes(cursor)
+                cursor.execute("ANALYZE")
                 
-                conn.commit()
                 self.logger.info("Database initialized successfully")
                 
         except sqlite3.Error as e:
             self.logger.error(f"Error initializing database: {e}")
             raise
 
-    def add_image(self, file_path: str, md5_hash: str, original_filename: str) -> int:
+    def _create_indexes(self, cursor: sqlite3.Cursor):
+        """Create the secondary indexes that bulk loading may drop."""
+        # UNIQUE(image_id, tag_id) already indexes lookups by image and
+        # UNIQUE on tags.name lookups by name; this covers the reverse
+        # direction, joining from a tag to its images
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_image_tags_tag
+            ON image_tags (tag_id, image_id)
+        """)
+        # Serves get_image_tags rows already sorted by occurrence count
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_image_tags_order
+            ON image_tags (image_id, occurrence_count DESC)
+        """)
+
+    def begin_bulk(self):
+        """
+        Prepare for inserting tags for many images.
+        
+        Drops secondary indexes so inserts only maintain the UNIQUE
+        constraints; call end_bulk() afterwards to restore them.
+        """
+        try:
+            with self._lock:
+                self._conn.execute("DROP INDEX IF EXISTS idx_image_tags_tag")
+                self._conn.execute("DROP INDEX IF EXISTS idx_image_tags_order")
+        except sqlite3.Error as e:
+            self.logger.error(f"Error starting bulk load: {e}")
+            raise
+
+    def end_bulk(self):
+        """Recreate the indexes dropped by begin_bulk() and refresh statistics."""
+        try:
+            with self._lock:
+                cursor = self._conn.cursor()
+                self._create_indexes(cursor)
+                cursor.execute("ANALYZE")
+        except sqlite3.Error as e:
+            self.logger.error(f"Error finishing bulk load: {e}")
+            raise
+
+    def _migrate_md5_hashes(self, cursor: sqlite3.Cursor):
+        """Convert hashes stored as hex text by older versions to raw bytes."""
+        cursor.execute("SELECT id, md5_hash FROM images WHERE typeof(md5_hash) = 'text'")
+        rows = []
+        for image_id, md5_hash in cursor.fetchall():
+            try:
+                rows.append((bytes.fromhex(md5_hash), image_id))
+            except ValueError:
+                self.logger.warning(f"Leaving non-hex hash of image {image_id} as text: {md5_hash}")
+        if rows:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany("UPDATE images SET md5_hash = ? WHERE id = ?", rows)
+            cursor.execute("COMMIT")
+            self.logger.info(f"Converted {len(rows)} image hashes to binary")
+
+    def add_image(self, file_path: str, md5_hash: bytes, original_filename: str) -> int:
         """
         Add an image to the database.
         
         Args:
             file_path: Path where the image is stored
-            md5_hash: MD5 hash of the image
+            md5_hash: Raw 16-byte MD5 digest of the image
             original_filename: Original filename of the image
             
         Returns:
             int: ID of the inserted image
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            with self._transaction() as cursor:
                 cursor.execute("""
                     INSERT OR IGNORE INTO images (file_path, md5_hash, original_filename)
                     VALUES (?, ?, ?)
@@ -87,6 +260,33 @@ class DatabaseManager:
             self.logger.error(f"Error adding image: {e}")
             raise
 
+    def get_or_create_image(self, file_path: str, md5_hash: bytes, original_filename: str) -> int:
+        """
+        Get the ID of an image by MD5 hash, adding the image if it is new.
+        
+        Args:
+            file_path: Path where the image is stored
+            md5_hash: Raw 16-byte MD5 digest of the image
+            original_filename: Original filename of the image
+            
+        Returns:
+            int: ID of the new or existing image
+        """
+        try:
+            with self._transaction() as cursor:
+                cursor.execute("""
+                    INSERT INTO images (file_path, md5_hash, original_filename)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(md5_hash) DO UPDATE SET
+                    original_filename = excluded.original_filename
+                    RETURNING id
+                """, (file_path, md5_hash, original_filename))
+                return cursor.fetchone()[0]
+                
+        except sqlite3.Error as e:
+            self.logger.error(f"Error getting or creating image: {e}")
+            raise
+
     def add_tags(self, image_id: int, tags: List[str]):
         """
         Add tags for an image and update confidence metrics.
@@ -96,9 +296,7 @@ class DatabaseManager:
             tags: List of tags to add
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            with self._transaction() as cursor:
                 # Increment the process count for the image
                 cursor.execute("""
                     UPDATE images 
@@ -106,26 +304,59 @@ class DatabaseManager:
                     WHERE id = ?
                 """, (image_id,))
                 
-                for tag in tags:
-                    # Insert or get tag
-                    cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
-                    cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
-                    tag_id = cursor.fetchone()[0]
-                    
-                    # Update tag occurrence count or insert new relationship
-                    cursor.execute("""
-                        INSERT INTO image_tags (image_id, tag_id, occurrence_count)
-                        VALUES (?, ?, 1)
-                        ON CONFLICT(image_id, tag_id) DO UPDATE SET
-                        occurrence_count = occurrence_count + 1
-                    """, (image_id, tag_id))
-
-                conn.commit()
+                tag_ids = self._cached_tag_ids(tags)
+                missing = [name for name in dict.fromkeys(tags) if name not in tag_ids]
+                fetched = {}
+                if missing:
+                    # Insert any new tags, then look up the ids of all of them at once
+                    cursor.executemany(
+                        "INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                        [(name,) for name in missing]
+                    )
+                    placeholders = ','.join('?' for _ in missing)
+                    cursor.execute(
+                        f"SELECT name, id FROM tags WHERE name IN ({placeholders})",
+                        missing
+                    )
+                    fetched = dict(cursor.fetchall())
+                    tag_ids.update(fetched)
+
+                # Update tag occurrence counts or insert new relationships
+                cursor.executemany("""
+                    INSERT INTO image_tags (image_id, tag_id, occurrence_count)
+                    VALUES (?, ?, 1)
+                    ON CONFLICT(image_id, tag_id) DO UPDATE SET
+                    occurrence_count = occurrence_count + 1
+                """, [(image_id, tag_ids[tag]) for tag in tags])
+
+            # Only cache ids once the transaction that created them committed
+            self._cache_tag_ids(fetched)
                 
         except sqlite3.Error as e:
             self.logger.error(f"Error adding tags: {e}")
             raise
 
+    def _cached_tag_ids(self, tags: List[str]) -> Dict[str, int]:
+        """Return the cached ids for those of the given tags that have one."""
+        tag_ids = {}
+        with self._lock:
+            for tag in tags:
+                tag_id = self._tag_id_cache.get(tag)
+                if tag_id is not None:
+                    self._tag_id_cache.move_to_end(tag)
+                    tag_ids[tag] = tag_id
+        return tag_ids
+
+    def _cache_tag_ids(self, tag_ids: Dict[str, int]):
+        """Remember tag ids, evicting the least recently used ones when full."""
+        with self._lock:
+            if self._in_batch:
+                self._batch_tag_ids.update(tag_ids)
+                return
+            self._tag_id_cache.update(tag_ids)
+            while len(self._tag_id_cache) > self.TAG_ID_CACHE_SIZE:
+                self._tag_id_cache.popitem(last=False)
+
     def get_image_tags(self, image_id: int) -> List[dict]:
         """
         Get all tags and their confidence metrics for an image.
@@ -137,45 +368,46 @@ class DatabaseManager:
             List[dict]: List of tags with confidence metrics
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            with self._lock:
+                cursor = self._conn.cursor()
                 cursor.execute("""
                     SELECT 
                         t.name,
                         it.occurrence_count,
-                        i.process_count,
-                        CAST(it.occurrence_count AS FLOAT) / i.process_count AS confidence
+                        i.process_count
                     FROM tags t
                     JOIN image_tags it ON t.id = it.tag_id
                     JOIN images i ON it.image_id = i.id
                     WHERE it.image_id = ?
-                    ORDER BY confidence DESC
+                    ORDER BY it.occurrence_count DESC
                 """, (image_id,))
                 
+                # process_count is the same for every row, so ordering by
+                # occurrence_count ranks by confidence and can use the index
                 return [{
                     'name': row[0],
                     'occurrence_count': row[1],
                     'process_count': row[2],
-                    'confidence': row[3]
+                    'confidence': row[1] / row[2] if row[2] else None
                 } for row in cursor.fetchall()]
                 
         except sqlite3.Error as e:
             self.logger.error(f"Error getting image tags: {e}")
             raise
 
-    def get_image_by_hash(self, md5_hash: str) -> Dict:
+    def get_image_by_hash(self, md5_hash: bytes) -> Dict:
         """
         Get image information by MD5 hash.
         
         Args:
-            md5_hash: MD5 hash of the image
+            md5_hash: Raw 16-byte MD5 digest of the image
             
         Returns:
             Dict: Image information or None if not found
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            with self._lock:
+                cursor = self._conn.cursor()
                 cursor.execute("""
                     SELECT id, file_path, original_filename, created_at
                     FROM images
@@ -194,4 +426,13 @@ class DatabaseManager:
                 
         except sqlite3.Error as e:
             self.logger.error(f"Error getting image by hash: {e}")
-            raise 
\ No newline at end of file
+            raise
+
+    def optimize(self):
+        """Let SQLite refresh query planner statistics where they are stale."""
+        try:
+            with self._lock:
+                self._conn.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            self.logger.error(f"Error optimizing database: {e}")
+            raise
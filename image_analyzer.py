@@ -1,24 +1,58 @@
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 from typing import List, Optional
 from PIL import Image
+import base64
 import io
 import json
-import re
+
+JPEG_MAGIC = b'\xff\xd8'
+JSON_DECODER = json.JSONDecoder()
+UNDERSCORE_TO_SPACE = str.maketrans('_', ' ')
+# LLaVA's vision encoder works on a few hundred pixels per side, so larger
+# images only inflate the request
+MAX_IMAGE_SIZE = (1024, 1024)
+
+DEFAULT_PROMPT = """Analyze this image and return an extensive list of tags in JSON format.
+The tags are used for image search, filtering, and organizing application.
+The tags should be as diverse as possible.
+The more tags the better.
+The more detailed tags the better.
+Example response format: { "tags": ["tag1", "tag2", "tag3"] }
+
+Return only the JSON object without any additional text."""
 
 class ImageAnalyzer:
     """Class responsible for AI-powered image analysis using Ollama with LLaVA model."""
     
-    def __init__(self, ollama_host: str = "http://localhost:11434", log_level: int = logging.WARNING):
+    def __init__(self, ollama_host: str = "http://localhost:11434", log_level: int = logging.WARNING, pool_size: int = 8):
         """Initialize the ImageAnalyzer with Ollama host configuration."""
         self.ollama_host = ollama_host
         self.model = "llava"
+        # Set once the model has been found; a missing model or unreachable
+        # server is checked again on the next call
+        self._model_available = False
+        self._generate_url = f"{self.ollama_host}/api/generate"
+        self._base_payload = {
+            "model": self.model,
+            "prompt": DEFAULT_PROMPT,
+            "stream": False
+        }
+        # Keep connections to Ollama alive between requests; pool_size should
+        # cover the number of threads analyzing images concurrently
+        self._session = requests.Session()
+        self._session.headers['Connection'] = 'keep-alive'
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
         logging.basicConfig(level=log_level)
         self.logger = logging.getLogger(__name__)
 
     def _prepare_image(self, image_path: str) -> Image.Image:
         """
-        Prepare the image for analysis by converting to RGB if necessary.
+        Prepare the image for analysis by converting to RGB if necessary
+        and downscaling it to fit within MAX_IMAGE_SIZE.
         
         Args:
             image_path: Path to the image file
@@ -30,6 +64,7 @@ class ImageAnalyzer:
             image = Image.open(image_path)
             if image.mode != 'RGB':
                 image = image.convert('RGB')
+            image.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
             return image
         except Exception as e:
             self.logger.error(f"Error preparing image: {str(e)}")
@@ -45,11 +80,33 @@ class ImageAnalyzer:
         Returns:
             str: Base64 encoded image string
         """
-        import base64
         buffer = io.BytesIO()
-        image.save(buffer, format="JPEG")
+        image.save(buffer, format="JPEG", quality=85, optimize=True)
         return base64.b64encode(buffer.getvalue()).decode('utf-8')
 
+    def _load_image_base64(self, image_path: str) -> str:
+        """
+        Load an image as a base64 encoded JPEG for API transmission.
+        
+        RGB JPEG files are sent as-is, skipping a decode and re-encode.
+        Anything else goes through PIL to be converted first.
+        
+        Args:
+            image_path: Path to the image file
+            
+        Returns:
+            str: Base64 encoded image string
+        """
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        if data.startswith(JPEG_MAGIC):
+            # Opening only parses the header, the pixel data is not decoded
+            with Image.open(io.BytesIO(data)) as image:
+                if image.mode == 'RGB':
+                    return base64.b64encode(data).decode('utf-8')
+        image = self._prepare_image(image_path)
+        return self._encode_image_base64(image)
+
     def _extract_json_from_text(self, text: str) -> List[dict]:
         """
         Extract JSON objects from text
@@ -68,28 +125,51 @@ class ImageAnalyzer:
             List[dict]: List of parsed JSON objects
         """
         json_objects = []
-        # Find all potential JSON objects using regex
-        json_pattern = r'\{[\s\S]*?\}'  # Modified pattern to include newlines
-        matches = re.finditer(json_pattern, text)
-        
-        for match in matches:
+        # Some responses escape the JSON's newlines as a literal backslash-n.
+        # Past the last such escape there is nothing to unescape.
+        last_escaped_newline = text.rfind('\\n')
+        unescaped = False
+
+        # Decode a JSON object at every opening brace, skipping past the
+        # ones that parse. Unlike a regex this never backtracks, and the
+        # text is unescaped at most once, so a response is scanned in a
+        # single pass.
+        pos = text.find('{')
+        while pos != -1:
             try:
-                # Clean up the matched text by removing escape characters
-                json_str = match.group().strip()
-                if '\\n' in json_str:  # If string contains escaped newlines
-                    json_str = json_str.encode().decode('unicode-escape')
-                # Try to parse the matched text as JSON
-                json_obj = json.loads(json_str)
-                # Validate that it has a 'tags' key and it's a list
-                if isinstance(json_obj.get('tags'), list):
-                    json_objects.append(json_obj)
+                json_obj, end = JSON_DECODER.raw_decode(text, pos)
             except json.JSONDecodeError as e:
+                if not unescaped and pos < last_escaped_newline:
+                    # Unescape the rest of the response once and rescan it
+                    text = self._unescape(text[pos:])
+                    unescaped = True
+                    pos = 0
+                    continue
                 self.logger.warning(f"Error parsing JSON: {str(e)}")
-                self.logger.warning(f"Failed JSON: {match.group()}")
+                pos = text.find('{', pos + 1)
                 continue
+            # Validate that it has a 'tags' key and it's a list
+            if isinstance(json_obj.get('tags'), list):
+                json_objects.append(json_obj)
+            pos = text.find('{', end)
         
         return json_objects
 
+    def _unescape(self, text: str) -> str:
+        """
+        Resolve backslash escapes such as \\n in text.
+        
+        Non-ASCII characters are kept intact and stray backslashes that do
+        not form a valid escape are left as they are instead of raising.
+        
+        Args:
+            text: String that may contain backslash escapes
+            
+        Returns:
+            str: Unescaped string
+        """
+        return text.encode('latin-1', 'backslashreplace').decode('unicode-escape', 'backslashreplace')
+
     def analyze_image(self, image_path: str, custom_prompt: Optional[str] = None) -> List[str]:
         """
         Analyze an image using the LLaVA model and return generated tags.
@@ -106,31 +186,15 @@ class ImageAnalyzer:
         """
         try:
             # Prepare the image
-            image = self._prepare_image(image_path)
-            base64_image = self._encode_image_base64(image)
-
-            # Prepare the prompt
-            if not custom_prompt:
-                custom_prompt = """Analyze this image and return an extensive list of tags in JSON format.
-The tags are used for image search, filtering, and organizing application.
-The tags should be as diverse as possible.
-The more tags the better.
-The more detailed tags the better.
-Example response format: { "tags": ["tag1", "tag2", "tag3"] }
+            base64_image = self._load_image_base64(image_path)
 
-Return only the JSON object without any additional text."""
-
-            # Prepare the API request
-            api_url = f"{self.ollama_host}/api/generate"
-            payload = {
-                "model": self.model,
-                "prompt": custom_prompt,
-                "images": [base64_image],
-                "stream": False
-            }
+            # Prepare the API request, only the image differs between calls
+            payload = {**self._base_payload, "images": [base64_image]}
+            if custom_prompt:
+                payload["prompt"] = custom_prompt
 
             # Make the API request
-            response = requests.post(api_url, json=payload, timeout=5)
+            response = self._session.post(self._generate_url, json=payload, timeout=5)
             response.raise_for_status()
 
             # Process the response
@@ -149,11 +213,8 @@ Return only the JSON object without any additional text."""
                 if isinstance(json_obj.get('tags'), list):
                     all_tags.update(json_obj['tags'])
             
-            tags = list(all_tags)
-            # Convert underscores to spaces and title case
-            tags = [tag.replace('_', ' ') for tag in tags]
-            # Convert to title case
-            tags = [tag.title() for tag in tags]
+            # Convert underscores to spaces and title case in a single pass
+            tags = list({tag.translate(UNDERSCORE_TO_SPACE).title() for tag in all_tags})
             self.logger.info(f"Generated {len(tags)} tags for image: {image_path}")
             return tags
 
@@ -168,16 +229,30 @@ Return only the JSON object without any additional text."""
         """
         Check if the LLaVA model is available and running in Ollama.
         
+        Once the model has been found this is cached for the lifetime of
+        the analyzer (until invalidate_model_cache() is called). A negative
+        or failed check is not cached, so the next call asks Ollama again.
+        
         Returns:
             bool: True if model is available, False otherwise
         """
+        if self._model_available:
+            return True
         try:
-            response = requests.get(f"{self.ollama_host}/api/tags")
+            response = self._session.get(f"{self.ollama_host}/api/tags", timeout=5)
             response.raise_for_status()
             available_models = response.json().get('models', [])
-            return any(model.get('name') == self.model for model in available_models)
-        except:
-            return False 
+        except Exception as e:
+            self.logger.warning(f"Could not list Ollama models: {str(e)}")
+            return False
+        # Ollama lists untagged pulls as e.g. "llava:latest"
+        names = {self.model, f"{self.model}:latest"}
+        self._model_available = any(model.get('name') in names for model in available_models)
+        return self._model_available
+
+    def invalidate_model_cache(self):
+        """Forget the cached is_model_available() result."""
+        self._model_available = False
 
 if __name__ == "__main__":
     import argparse
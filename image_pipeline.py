@@ -1,6 +1,7 @@
 import os
 import logging
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple
 from pathlib import Path
 
 from tqdm import tqdm
@@ -8,18 +9,25 @@ from tqdm import tqdm
 from image_analyzer import ImageAnalyzer
 from db_manager import DatabaseManager
 
+IMAGE_SUFFIXES = {'.jpg', '.jpeg'}
+
 class ImagePipeline:
     """Pipeline for processing images and storing their tags."""
     
-    def __init__(self, image_dir: str = "images", log_level: int = logging.WARNING):
+    # Number of images whose writes are committed together
+    BATCH_SIZE = 32
+    
+    def __init__(self, image_dir: str = "images", log_level: int = logging.WARNING, max_workers: int = 4):
         """
         Initialize the image processing pipeline.
         
         Args:
             image_dir: Directory containing images
+            max_workers: Number of images analyzed concurrently
         """
         self.image_dir = Path(image_dir)
-        self.analyzer = ImageAnalyzer()
+        self.max_workers = max_workers
+        self.analyzer = ImageAnalyzer(pool_size=max_workers)
         self.db = DatabaseManager()
         self.logger = logging.getLogger(__name__)
         
@@ -32,9 +40,17 @@ class ImagePipeline:
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
 
-    def get_hash_from_filename(self, image_path: Path) -> str:
-        """Extract MD5 hash from filename."""
-        return image_path.stem  # Return filename without extension
+    def get_hash_from_filename(self, image_path: Path) -> bytes:
+        """
+        Extract MD5 hash from filename as raw bytes.
+        
+        Raises:
+            ValueError: If the filename is not a hex MD5 digest
+        """
+        md5_hash = bytes.fromhex(image_path.stem)  # Filenames are hex digests
+        if len(md5_hash) != 16:
+            raise ValueError(f"expected a 32 character MD5 digest, got {image_path.stem!r}")
+        return md5_hash
 
     def process_image(self, image_path: Path) -> Optional[int]:
         """
@@ -44,6 +60,49 @@ class ImagePipeline:
         Args:
             image_path: Path to the image file
             
+        Returns:
+            Optional[int]: Image ID if successful, None if failed
+        """
+        tags_data = self._analyze_image(image_path)
+        if tags_data is None:
+            return None
+        return self._store_tags(image_path, tags_data)
+
+    def _analyze_image(self, image_path: Path) -> Optional[List[str]]:
+        """
+        Generate tags for an image without touching the database.
+        
+        Args:
+            image_path: Path to the image file
+            
+        Returns:
+            Optional[List[str]]: Generated tags, None if analysis failed
+        """
+        # Check the name before paying for an Ollama request whose result
+        # could not be stored
+        try:
+            self.get_hash_from_filename(image_path)
+        except ValueError:
+            self.logger.warning(
+                f"Skipping image not named by its MD5 hash (see rename_images.py): {image_path.name}"
+            )
+            return None
+        
+        try:
+            self.logger.info(f"Analyzing image: {image_path.name}")
+            return self.analyzer.analyze_image(str(image_path))
+        except Exception as e:
+            self.logger.error(f"Error processing image {image_path.name}: {str(e)}")
+            return None
+
+    def _store_tags(self, image_path: Path, tags_data: List[str]) -> Optional[int]:
+        """
+        Store generated tags for an image, creating its record if needed.
+        
+        Args:
+            image_path: Path to the image file
+            tags_data: Tags generated for the image
+            
         Returns:
             Optional[int]: Image ID if successful, None if failed
         """
@@ -52,32 +111,42 @@ class ImagePipeline:
             md5_hash = self.get_hash_from_filename(image_path)
             
             # Get or create image record
-            existing_image = self.db.get_image_by_hash(md5_hash)
-            if existing_image:
-                image_id = existing_image["id"]
-                self.logger.info(f"Processing existing image again: {image_path.name}")
-            else:
-                # Add new image to database
-                image_id = self.db.add_image(
-                    str(image_path),
-                    md5_hash,
-                    image_path.name
-                )
-                self.logger.info(f"Added new image to database: {image_path.name}")
-            
-            # Generate tags
-            tags_data = self.analyzer.analyze_image(str(image_path))
+            image_id = self.db.get_or_create_image(
+                str(image_path),
+                md5_hash,
+                image_path.name
+            )
             
             # Store tags in database (this will now update confidence metrics)
             self.db.add_tags(image_id, tags_data)
             
-            self.logger.info(f"Successfully processed image: {image_path.name}")
+            self.logger.info(f"Successfully processed image {image_id}: {image_path.name}")
             return image_id
             
         except Exception as e:
             self.logger.error(f"Error processing image {image_path.name}: {str(e)}")
             return None
 
+    def _store_batch(self, results: List[Tuple[Path, List[str]]]) -> List[int]:
+        """
+        Store the tags of several analyzed images in one transaction.
+        
+        Args:
+            results: Pairs of image path and its generated tags
+            
+        Returns:
+            List[int]: IDs of the images stored successfully
+        """
+        image_ids = []
+        if not results:
+            return image_ids
+        with self.db.batch():
+            for image_path, tags_data in results:
+                image_id = self._store_tags(image_path, tags_data)
+                if image_id is not None:
+                    image_ids.append(image_id)
+        return image_ids
+
     def process_directory(self) -> List[int]:
         """
         Process all images in the input directory.
@@ -87,14 +156,47 @@ class ImagePipeline:
         """
         processed_ids = []
         
-        # Get all jpg files
-        image_files = list(self.image_dir.glob("*.jpg")) + list(self.image_dir.glob("*.jpeg"))
+        # Fail fast instead of erroring on every image
+        if not self.analyzer.is_model_available():
+            self.logger.error(f"Model {self.analyzer.model} is not available at {self.analyzer.ollama_host}")
+            return processed_ids
         
-        for image_path in tqdm(image_files, desc="Processing images", unit="image"):
-            image_id = self.process_image(image_path)
-            if image_id is not None:
-                processed_ids.append(image_id)
+        # Get all jpg files in a single pass over the directory
+        image_files = [p for p in self.image_dir.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES]
+        
+        # Secondary indexes are rebuilt once at the end instead of per insert
+        self.db.begin_bulk()
+        try:
+            # Analysis mostly waits on the Ollama server, so overlap the
+            # requests, keeping every worker busy until all images are
+            # submitted. Finished results are written BATCH_SIZE at a time in
+            # one short transaction, so the write lock is never held during
+            # analysis. Redraw the progress bar at most ~100 times per run.
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor, tqdm(
+                total=len(image_files),
+                desc="Processing images",
+                unit="image",
+                miniters=max(1, len(image_files) // 100),
+                mininterval=0.5,
+            ) as pbar:
+                futures = {
+                    executor.submit(self._analyze_image, image_path): image_path
+                    for image_path in image_files
+                }
+                results = []
+                for future in as_completed(futures):
+                    tags_data = future.result()
+                    if tags_data is not None:
+                        results.append((futures[future], tags_data))
+                    pbar.update(1)
+                    if len(results) >= self.BATCH_SIZE:
+                        processed_ids.extend(self._store_batch(results))
+                        results = []
+                processed_ids.extend(self._store_batch(results))
+        finally:
+            self.db.end_bulk()
         
+        self.db.optimize()
         self.logger.info(f"Processed {len(processed_ids)} images successfully")
         return processed_ids
 
@@ -104,9 +206,10 @@ def main():
     
     parser = argparse.ArgumentParser(description='Process images and generate tags using LLaVA model.')
     parser.add_argument('--repeat', type=int, default=1, help='Number of times to repeat the tagging process (default: 1)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of images to analyze concurrently (default: 4)')
     args = parser.parse_args()
     
-    pipeline = ImagePipeline()
+    pipeline = ImagePipeline(max_workers=args.workers)
     for i in range(args.repeat):
         print(f"\nProcessing round {i + 1} of {args.repeat}")
         pipeline.process_directory()
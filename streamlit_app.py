@@ -38,7 +38,7 @@ def load_images(conn, selected_tags=None, date_range=None, filename_search=None)
             i.file_path, 
             i.original_filename, 
             i.created_at,
-            i.md5_hash,
+            lower(hex(i.md5_hash)) AS md5_hash,
             GROUP_CONCAT(t.name) as tags
         FROM images i
         LEFT JOIN image_tags it ON i.id = it.image_id